@@ -1,6 +1,110 @@
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import chain
+
 import pandas as pd
 import numpy as np
-from scipy.stats import chisquare
+from scipy.sparse import coo_matrix
+from scipy.stats import chi2
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# Contingency tables with more cells than this are counted sparsely
+SPARSE_THRESHOLD = 10000
+
+
+def _all_contingencies(codes_matrix, n_categories, target_codes, n_target_categories):
+    """
+    Counts co-occurrences of integer category codes, equivalent to
+    pd.crosstab on categorical data, for many questions at once. Each
+    column of codes_matrix holds the codes of one question and all the
+    tables are filled in a single np.bincount pass. Missing values
+    (code -1) are ignored and categories that were never observed are
+    dropped.
+
+    """
+    sizes = np.asarray(n_categories, dtype=np.intp) * n_target_categories
+    offsets = np.cumsum(sizes) - sizes
+    mask = (codes_matrix >= 0) & (target_codes >= 0)[:, np.newaxis]
+    flat = codes_matrix * n_target_categories + target_codes[:, np.newaxis] + offsets
+    counts = np.bincount(flat[mask], minlength=sizes.sum())
+
+    tables = []
+    for offset, size, n_rows in zip(offsets, sizes, n_categories):
+        table = counts[offset:offset + size].reshape(n_rows, n_target_categories)
+        tables.append(table[table.any(axis=1)][:, table.any(axis=0)])
+    return tables
+
+
+def _contingency_table(codes, target_codes, n_categories, n_target_categories):
+    """
+    Single question version of _all_contingencies. Large tables, e.g. of
+    multiple choice questions with many rare answers, are counted in a
+    sparse matrix and only their observed rows and columns are densified.
+
+    """
+    if n_categories * n_target_categories <= SPARSE_THRESHOLD:
+        return _all_contingencies(codes[:, np.newaxis], [n_categories], target_codes, n_target_categories)[0]
+
+    mask = (codes >= 0) & (target_codes >= 0)
+    table = coo_matrix((np.ones(np.count_nonzero(mask), dtype=np.int64), (codes[mask], target_codes[mask])),
+                       shape=(n_categories, n_target_categories)).tocsr()
+    rows = np.flatnonzero(table.getnnz(axis=1))
+    cols = np.flatnonzero(table.getnnz(axis=0))
+    return table[rows][:, cols].toarray()
+
+
+def _chi_square(observed, row_sums, col_sums):
+    """
+    Returns the chi square statistic of a contingency table given its
+    row and column sums.
+
+    """
+    expected = np.outer(row_sums, col_sums) / row_sums.sum()
+    # The difference buffer is squared and scaled in place
+    diff = np.subtract(observed, expected, dtype=np.float64)
+    np.square(diff, out=diff)
+    diff /= expected
+    return float(diff.sum())
+
+
+if numba is not None:
+    # Fused loops avoid the temporary arrays and per-call numpy overhead,
+    # which dominate on the small tables of a typical survey
+    @numba.njit(cache=True)
+    def _chi_square(observed, row_sums, col_sums):
+        n_rows, n_cols = observed.shape
+        n = row_sums.sum()
+        stat = 0.0
+        for i in range(n_rows):
+            for j in range(n_cols):
+                expected = row_sums[i] * col_sums[j] / n
+                diff = observed[i, j] - expected
+                stat += diff * diff / expected
+        return stat
+
+
+def _analyze(n_observed, min_count, significance_level):
+    """
+    Tests a contingency table for independence. Returns the outcome
+    ('invalid', 'related' or 'not related'), the statistic and the
+    p-value. The latter two are None if the test is invalid.
+
+    """
+    row_sums = np.sum(n_observed, axis=1)
+    col_sums = np.sum(n_observed, axis=0)
+    n = row_sums.sum()
+    # The smallest expected count is the product of the smallest sums
+    if n == 0 or row_sums.min() * col_sums.min() / n < min_count:
+        return 'invalid', None, None
+
+    stat = _chi_square(n_observed, row_sums, col_sums)
+    dof = (n_observed.shape[0] - 1) * (n_observed.shape[1] - 1)
+    p = chi2.sf(stat, dof)
+    return ('related' if p <= significance_level else 'not related'), stat, p
 
 
 class QuestionDependence:
@@ -34,41 +138,57 @@ class QuestionDependence:
     significance_level : float
         Threshold for p-value, below which the test's null hypothesis
         will be rejected, i.e. the questions are related
+    verbose : bool
+        Whether to print general info and the frequency tables of every
+        analyzed question. The final stats are always printed
+    n_jobs : int
+        Number of processes the questions are tested in. -1 uses all
+        processors. With more than one process the calling script has
+        to be guarded by if __name__ == '__main__'
 
     """
 
-    def __init__(self, path, target=-1, single=(), multi=(), multi_delimiter=',', min_count=5, significance_level=0.1):
-        self.df = pd.read_csv(path).astype('category')
-
+    def __init__(self, path, target=-1, single=(), multi=(), multi_delimiter=',', min_count=5, significance_level=0.1,
+                 verbose=False, n_jobs=1):
+        self.questions = pd.read_csv(path, nrows=0).columns
         if target == -1:
-            target = len(self.df.columns) - 1
+            target = len(self.questions) - 1
+        # Only the analyzed questions are parsed, straight into categoricals
+        usecols = [self.questions[i] for i in sorted({target, *single, *multi})]
+        self.df = pd.read_csv(path, usecols=usecols, dtype={name: 'category' for name in usecols})
+
         self.target = target
         self.single = single
         self.multi = multi
         self.multi_delimiter = multi_delimiter
         self.min_count = min_count
         self.significance_level = significance_level
+        self.verbose = verbose
+        self.n_jobs = n_jobs
 
-        self.target_column = self.df.iloc[:, self.target]
-        self.target_categories = self.target_column.cat.categories.values
-        self.n_target_categories = len(self.target_categories)
-        self.target_value_counts = self.target_column.value_counts()
+        self.target_column = self.df[self.questions[self.target]]
+        self.target_categories = self.target_column.cat.categories
+        self.n_target_categories = self.target_categories.size
+        self.target_codes = self.target_column.cat.codes.values.astype(np.int32)
+        self.target_value_counts = np.bincount(self.target_codes[self.target_codes >= 0],
+                                               minlength=self.n_target_categories)
 
         self.stats = {'invalid': [],
                       'related': [],
                       'not related': []}
 
-        self.print_info()
+        if self.verbose:
+            self.print_info()
         self.run()
         self.print_stats()
 
     def print_info(self):
         print('-' * 5, 'GENERAL INFO', '-' * 5)
-        print('Number of questions:', len(self.df.columns))
+        print('Number of questions:', len(self.questions))
         print('Target question (%d): %s' % (self.target, self.target_column.name))
         print('Target question categories (%d): %s' % (self.n_target_categories, self.target_categories))
         print('Target value counts:')
-        for k, v in self.target_value_counts.iteritems():
+        for k, v in zip(self.target_categories, self.target_value_counts):
             print(k, '-', v)
         print('Significance level:', self.significance_level)
         print('Minimum expected count:', self.min_count)
@@ -77,14 +197,34 @@ class QuestionDependence:
         print('\f', end='')
 
     def run(self):
-        for i_question in sorted(self.single + self.multi):
-            column = self.df.iloc[:, i_question]
-            if i_question in self.single:
-                self.analyze_question(column, self.target_column, i_question)
+        columns = {i_question: self.df[self.questions[i_question]] for i_question in self.single}
+        codes_matrix = np.empty((len(self.df), len(columns)), dtype=np.int32)
+        for j, column in enumerate(columns.values()):
+            codes_matrix[:, j] = column.cat.codes
+        n_categories = [column.cat.categories.size for column in columns.values()]
+        observed = dict(zip(columns, _all_contingencies(codes_matrix, n_categories,
+                                                        self.target_codes, self.n_target_categories)))
+
+        for i_question in self.multi:
+            column, target_column = self.convert_multi_to_single(self.df[self.questions[i_question]])
+            columns[i_question] = column
+            observed[i_question] = _contingency_table(column.cat.codes.values.astype(np.int32),
+                                                      target_column.cat.codes.values.astype(np.int32),
+                                                      column.cat.categories.size, self.n_target_categories)
+
+        questions = sorted(observed)
+        tables = [observed[i_question] for i_question in questions]
+        analyze = partial(_analyze, min_count=self.min_count, significance_level=self.significance_level)
+        if self.n_jobs == 1:
+            results = list(map(analyze, tables))
+        else:
+            with ProcessPoolExecutor(None if self.n_jobs == -1 else self.n_jobs) as executor:
+                results = list(executor.map(analyze, tables))
 
-            elif i_question in self.multi:
-                column, target_column = self.convert_multi_to_single(column)
-                self.analyze_question(column, target_column, i_question)
+        for i_question, n_observed, (outcome, stat, p) in zip(questions, tables, results):
+            self.stats[outcome].append(i_question)
+            if self.verbose:
+                self.print_question(columns[i_question], n_observed, i_question, outcome, stat, p)
 
     def print_stats(self):
         print('-' * 5, 'STATS', '-' * 5)
@@ -93,52 +233,27 @@ class QuestionDependence:
                                                                     self.stats['not related']))
         print('Questions that render the test invalid (%d): %s' % (len(self.stats['invalid']), self.stats['invalid']))
 
-    def analyze_question(self, column, target_column, i_question):
+    def print_question(self, column, n_observed, i_question, outcome, stat, p):
+        categories = column.cat.categories
         print('Question', i_question)
         print(column.name)
-        categories = column.cat.categories.values
-        n_categories = len(categories)
-        print('Categories (%d): %s' % (n_categories, categories))
-
-        n_observed = pd.crosstab(column, target_column)
+        print('Categories (%d): %s' % (categories.size, categories))
         print('Observed frequencies:')
-        print(n_observed.values)
-
-        row_sums = np.sum(n_observed.values, axis=1)
-        col_sums = np.sum(n_observed.values, axis=0)
-        n = sum(row_sums)
-        n_expected = np.array([[row * col / n for col in col_sums] for row in row_sums])
+        print(n_observed)
+        n_expected = np.outer(n_observed.sum(axis=1), n_observed.sum(axis=0)) / n_observed.sum()
         print('Expected frequencies:')
-        with np.printoptions(precision=2):
-            print(n_expected)
+        print(np.array2string(n_expected, precision=2))
 
-        if np.any(n_expected < self.min_count):
+        if outcome == 'invalid':
             print('Expected count too low (below %d). TEST INVALID.' % self.min_count)
-            print('\f', end='')
-            self.stats['invalid'].append(i_question)
-            return
-
-        # Scipy's chisquare function uses flattened data and is unable to
-        # properly infer the number of degrees of freedom. We use delta
-        # degrees of freedom (ddof) to adjust the value.
-        # dof = k - 1 - ddof
-        # k = r * c
-        # ddof = r * c - 1 - (r - 1) * (c - 1)
-        # ddof = r + c - 2
-        # where r - number of rows and c - number of columns
-        ddof = n_categories + self.n_target_categories - 2
-
-        stat, p = chisquare(n_observed.values, n_expected, axis=None, ddof=ddof)
-        print('Statistic:', stat)
-        print('P-value:', p)
-        print('Interpretation: ', end='')
-        if p <= self.significance_level:
-            print('There is a relationship between this and the target question.')
-            self.stats['related'].append(i_question)
         else:
-            print('There is NO relationship between this and the target question.')
-            self.stats['not related'].append(i_question)
-
+            print('Statistic:', stat)
+            print('P-value:', p)
+            print('Interpretation: ', end='')
+            if outcome == 'related':
+                print('There is a relationship between this and the target question.')
+            else:
+                print('There is NO relationship between this and the target question.')
         print('\f', end='')
 
     def convert_multi_to_single(self, column):
@@ -149,15 +264,10 @@ class QuestionDependence:
         ([1, 2, 3], 'Yes') -> (1, 'Yes'), (2, 'Yes'), (3, 'Yes')
 
         """
-        df = pd.DataFrame()
-
-        for row_data, row_target in zip(column, self.target_column):
-            data = [v.strip() for v in row_data.split(self.multi_delimiter)]
-            for d in data:
-                df = df.append([[d, row_target]])
+        answers = column.dropna().astype(str).str.split(self.multi_delimiter)
+        data = pd.Series(list(chain.from_iterable(answers)), name=column.name).str.strip()
+        target = self.target_column[answers.index].repeat(answers.str.len())
 
-        df = df.astype('category')
-        new_column = df.iloc[:, 0]
-        target_column = df.iloc[:, 1]
-        new_column.name = column.name
+        new_column = data.astype('category')
+        target_column = target.reset_index(drop=True)
         return new_column, target_column